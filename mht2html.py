@@ -1,11 +1,27 @@
 import re
 import os
-import base64
+import sys
+import copy
+import mmap
 import argparse
+import binascii
+import contextlib
+import functools
+import itertools
 from tqdm import tqdm
-from bs4 import BeautifulSoup
-from typing import Dict, Optional, Tuple
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.message import Message
+from email.parser import HeaderParser
+import lxml.html
+from lxml import etree
+from lxml.html import HtmlElement
+from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+# 优先使用 SIMD 加速的 pybase64，未安装时回退到标准库
+try:
+    import pybase64 as _b64
+except ImportError:
+    import base64 as _b64
 
 CONTENT_TYPE_MAP = {
     "image/jpeg": "jpg",
@@ -13,38 +29,130 @@ CONTENT_TYPE_MAP = {
     "image/gif": "gif"
 }
 
-def parse_headers(headers_str: str) -> Dict[str, str]:
-    """解析 HTTP 头部字符串为字典"""
-    headers = {}
-    for line in headers_str.split("\n"):
-        if ":" in line:
-            key, value = line.split(":", 1)
-            headers[key.strip().lower()] = value.strip()
-    return headers
+STYLE_SPLIT_RE = re.compile(r"\s*;\s*")
+HEADER_PARSER = HeaderParser()
+# 空白记录的替换内容，每次处理只解析一次，之后按需复制
+EMPTY_MSG_HTML = (
+    '<div style="padding-left:20px;">'
+    '<font style="font-size:10pt;font-family:\'宋体\',\'MS Sans Serif\',sans-serif;" color="000000">[不支持导出的消息类型]</font>'
+    '</div>'
+)
+# 一次遍历选出不含图片且去除空白后无文本的消息 div
+EMPTY_MSG_XPATH = etree.XPath(
+    'descendant::div[@style="padding-left:20px;"]'
+    '[not(descendant::img)]'
+    '[not(normalize-space(translate(., "\u00a0\u3000", "  ")))]'
+)
+
+# 声明字符集的 meta 标签，http-equiv 取值不区分大小写
+CHARSET_META_XPATH = etree.XPath(
+    'descendant::meta[@charset or translate(@http-equiv, "CONTENT-YP", "content-yp") = "content-type"]'
+)
+
+def normalize_style(style: str) -> str:
+    """规范化内联样式，去除声明间多余的空白"""
+    declarations = []
+    for declaration in STYLE_SPLIT_RE.split(style):
+        name, sep, value = declaration.partition(":")
+        if sep:
+            declarations.append(f"{name.strip()}:{value.strip()}")
+        elif declaration := declaration.strip():  # 如 url(data:...;base64,...) 中被拆开的部分，原样保留
+            declarations.append(declaration)
+    return ";".join(declarations)
+
+@functools.lru_cache(maxsize=None)
+def get_html_parser(charset: str) -> lxml.html.HTMLParser:
+    """按字符集缓存 HTML 解析器"""
+    # 放开 libxml2 对超大文本节点和嵌套深度的限制，避免大型聊天记录被截断
+    try:
+        return lxml.html.HTMLParser(huge_tree=True, encoding=charset)
+    except LookupError:  # libxml2 不认识的字符集标签按 UTF-8 处理
+        return get_html_parser("utf-8")
+
+def parse_headers(data: bytes) -> Message:
+    """按 UTF-8 解码头部后解析，非 ASCII 的头部值同样得到 str"""
+    return HEADER_PARSER.parsestr(data.decode("utf-8", "replace"))
+
+def find_header_end(buffer: mmap.mmap, start: int, end: int) -> Tuple[int, int]:
+    """查找 [start, end) 内分隔头部与正文的空行，返回 (头部结束位置, 正文起始位置)"""
+    # 没有头部的分段以空行开头
+    if buffer[start:start + 1] == b"\n":
+        return start, start + 1
+    if buffer[start:start + 2] == b"\r\n":
+        return start, start + 2
+
+    pos = start
+    while (pos := buffer.find(b"\n", pos, end)) != -1:
+        pos += 1
+        if buffer[pos:pos + 1] == b"\n":
+            return pos, pos + 1
+        if buffer[pos:pos + 2] == b"\r\n":
+            return pos, pos + 2
+    return -1, -1
+
+def split_part(buffer: mmap.mmap, start: int, end: int) -> Tuple[Message, memoryview]:
+    """拆分 [start, end) 范围内的 MIME 分段为头部与正文，start 指向分隔符所在行的剩余部分"""
+    if (line_end := buffer.find(b"\n", start, end)) == -1:
+        return Message(), memoryview(b"")
+
+    start = line_end + 1
+    header_end, body_start = find_header_end(buffer, start, end)
+    if header_end == -1:
+        return parse_headers(buffer[start:end]), memoryview(b"")
+
+    if buffer[end - 1:end] == b"\r":  # 分隔符前的换行属于分隔符
+        end -= 1
+    return parse_headers(buffer[start:header_end]), memoryview(buffer)[body_start:end]
+
+def split_parts(buffer: mmap.mmap) -> List[Tuple[Message, memoryview]]:
+    """按 boundary 将 MHT 文件拆分为各个 MIME 分段，正文以 memoryview 引用原缓冲区"""
+    header_end, _ = find_header_end(buffer, 0, len(buffer))
+    if header_end == -1:
+        raise ValueError("无效的 MHT 文件格式：缺少 boundary 声明")
+
+    if not (boundary := parse_headers(buffer[:header_end]).get_boundary()):
+        raise ValueError("无效的 MHT 文件格式：缺少 boundary 声明")
+
+    delimiter = b"\n--" + boundary.encode("ascii")
+    parts = []
+    pos = buffer.find(delimiter)
+    while pos != -1:
+        start = pos + len(delimiter)
+        if buffer[start:start + 2] == b"--":  # 结束分隔符
+            break
+        pos = buffer.find(delimiter, start)
+        parts.append(split_part(buffer, start, len(buffer) if pos == -1 else pos))
+    return parts
+
+def decode_body(data: memoryview, encoding: str) -> bytes:
+    """按 Content-Transfer-Encoding 解码正文"""
+    if encoding == "base64":
+        return _b64.b64decode(data, validate=False)
+    if encoding == "quoted-printable":
+        return binascii.a2b_qp(data)
+    return data
 
 def save_resource(
     content_location: str,
     content_type: str,
-    data: str,
+    data: memoryview,
     encoding: str,
     resource_dir: str,
     progress_callback=None
 ) -> Optional[Tuple[str, str]]:
     """保存资源文件到指定目录"""
     try:
-        original_name = os.path.basename(content_location)
-        base_name = os.path.splitext(original_name)[0]
-        extension = CONTENT_TYPE_MAP.get(content_type, content_type.split("/")[-1].split("+")[-1])
+        base_name = os.path.splitext(os.path.basename(content_location))[0]
+        if (extension := CONTENT_TYPE_MAP.get(content_type)) is None:
+            extension = content_type.rpartition("/")[2].rpartition("+")[2]
 
-        os.makedirs(resource_dir, exist_ok=True)
-        filename = f"{base_name}.{extension}"
-        file_path = os.path.join(resource_dir, filename)
+        file_path = f"{resource_dir}/{base_name}.{extension}"
 
         # 处理编码
-        content = base64.b64decode(data) if encoding == "base64" else data.encode("utf-8")
+        data = decode_body(data, encoding)
 
         with open(file_path, "wb") as f:
-            f.write(content)
+            f.write(data)
 
         if progress_callback:
             progress_callback(1)  # 每保存一个资源，更新进度条
@@ -58,127 +166,146 @@ class MHTProcessor:
     def __init__(self, max_workers: int = 4):
         self.executor = ThreadPoolExecutor(max_workers=max_workers)
 
-    def empty_msg(self, soup: BeautifulSoup) -> None:
+    def empty_msg(self, doc: HtmlElement) -> None:
         """处理空白记录"""
-        for div in soup.find_all("div", style="padding-left:20px;"):
-            if div.find("img"):  # 跳过有图片的 div
-                continue
-
-            if not div.get_text(strip=True):  # 如果是空白消息
-                new_div = soup.new_tag("div", **{"style": "padding-left:20px;"})
-                new_font = soup.new_tag("font", style="font-size:10pt;font-family:'宋体','MS Sans Serif',sans-serif;", color="000000")
-                new_font.string = "[不支持导出的消息类型]"
-                new_div.append(new_font)
-                div.insert_before(new_div)
-                div.decompose()
+        template = lxml.html.fragment_fromstring(EMPTY_MSG_HTML)
+        for div in EMPTY_MSG_XPATH(doc):
+            new_div = copy.deepcopy(template)
+            new_div.tail = div.tail
+            div.getparent().replace(div, new_div)
 
         print("空白记录已成功替换为提示文本。")
 
-    def process_styles(self, soup: BeautifulSoup) -> str:
+    def process_styles(self, doc: HtmlElement) -> str:
         """将内联样式转换为 CSS 类"""
         style_map = {}
+        class_map = {}
         css_rules = []
-        counter = 1
+        counter = itertools.count(1)
         
-        for element in soup.find_all(style=True):
+        for element in doc.xpath("descendant-or-self::*[@style]"):
             original_style = element.get("style", "").strip()
             if not original_style:
                 continue
 
-            if original_style not in style_map:
-                class_name = f"i-style-{counter}"
+            if (class_name := style_map.get(original_style)) is None:
+                # 仅空白不同的样式共用同一个类
+                normalized = normalize_style(original_style)
+                if (class_name := class_map.get(normalized)) is None:
+                    class_name = f"i-style-{next(counter)}"
+                    class_map[normalized] = class_name
+                    css_rules.append(f".{class_name} {{ {normalized} }}")
                 style_map[original_style] = class_name
-                css_rules.append(f".{class_name} {{ {original_style} }}")
-                counter += 1
 
-            element["class"] = element.get("class", []) + [style_map[original_style]]
-            del element["style"]
+            if classes := element.get("class"):
+                class_name = f"{classes} {class_name}"
+            element.set("class", class_name)
+            del element.attrib["style"]
         print("内联样式已成功转换为 CSS 类。")
 
         return "\n".join(css_rules)
 
-    def update_references(self, soup: BeautifulSoup, resource_map: Dict[str, str], output_path: str) -> None:
+    def update_references(self, doc: HtmlElement, resource_map: Dict[str, str], output_path: str) -> None:
         """更新 HTML 资源引用路径"""
-        for tag in soup.find_all(["img", "link", "script"]):
-            attr = "src" if tag.name == "img" else "href"
-            if resource_path := resource_map.get(tag.get(attr, "")):
-                relative_path = os.path.relpath(resource_path, start=os.path.dirname(output_path))
-                tag[attr] = relative_path
+        base_dir = os.path.dirname(output_path)
+        # 每个资源只计算一次相对路径，多处引用同一资源时直接复用
+        relative_map = {
+            location: os.path.relpath(resource_path, start=base_dir)
+            for location, resource_path in resource_map.items()
+        }
+        for tag in doc.xpath("descendant::img|descendant::link|descendant::script"):
+            attr = "src" if tag.tag == "img" else "href"
+            if (relative_path := relative_map.get(tag.get(attr))) is not None:
+                tag.set(attr, relative_path)
         print("HTML 中的资源引用路径已成功更新。")
 
+    def update_charset(self, doc: HtmlElement) -> None:
+        """输出统一为 UTF-8，同步改写页面中声明字符集的 meta 标签"""
+        for meta in CHARSET_META_XPATH(doc):
+            if meta.get("charset") is not None:
+                meta.set("charset", "utf-8")
+            else:
+                meta.set("content", "text/html; charset=utf-8")
+
     def process(self, mht_path: str, output_path: str, resource_dir: str = "images") -> bool:
         """主处理流程"""
         try:
             print(f"正在读取 MHT 文件：{mht_path}...")
-            with open(mht_path, "r", encoding="utf-8") as f:
-                content = f.read()
-
-            if not (boundary_match := re.search(r'boundary="([^"]+)"', content)):
-                raise ValueError("无效的 MHT 文件格式：缺少 boundary 声明")
-            
-            boundary = boundary_match.group(1)
-            parts = re.split(rf"--{boundary}(?:--)?\n", content)
-
-            html_part = next((p for p in parts if "Content-Type: text/html" in p), None)
-            if not html_part:
-                raise ValueError("MHT 文件中缺少 HTML 内容")
-
-            if not (html_match := re.search(r"(?:\n\n|\r\n\r\n)(.*?)(?=\n--|$)", html_part, re.DOTALL)):
-                raise ValueError("HTML 内容解析失败")
-            
-            soup = BeautifulSoup(html_match.group(1).strip(), "html.parser")
-
-            self.empty_msg(soup)
-
-            css_content = self.process_styles(soup)
-
-            futures = []
-            resource_map = {}
-            # 计算资源数量
-            total_resources = sum(1 for part in parts if "Content-Location:" in part)
-
-            with tqdm(total=total_resources, desc="资源转存进度", ncols=100) as progress_bar:
-                for part in parts:
-                    if "Content-Location:" not in part:
-                        continue
-
-                    headers_str, _, body = part.partition("\n\n")
-                    headers = parse_headers(headers_str)
-                    content_location = headers.get("content-location")
-                    content_type = headers.get("content-type", "").split(";")[0]
-                    encoding = headers.get("content-transfer-encoding", "7bit")
-
-                    if content_type.startswith("text/html"):
-                        continue
-
-                    futures.append(
-                        self.executor.submit(
-                            save_resource,
-                            content_location,
-                            content_type,
-                            body.strip(),
-                            encoding,
-                            resource_dir,
-                            progress_bar.update  # 更新进度条
-                        )
-                    )
-
-                for future in as_completed(futures):
-                    if result := future.result():
-                        resource_map[result[0]] = result[1]
-
-            self.update_references(soup, resource_map, output_path)
+            with open(mht_path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    raise ValueError("无效的 MHT 文件格式：缺少 boundary 声明")
+                # 映射整个文件，各分段正文都是映射上的切片，不产生拷贝
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            try:
+                parts = split_parts(buffer)
+
+                html_part = next(((h, b) for h, b in parts if h.get_content_type() == "text/html"), None)
+                if html_part is None:
+                    raise ValueError("MHT 文件中缺少 HTML 内容")
+
+                html_headers, html_body = html_part
+                encoding = html_headers.get("Content-Transfer-Encoding", "7bit").strip().lower()
+                if not (html_data := bytes(decode_body(html_body, encoding)).strip()):
+                    raise ValueError("HTML 内容解析失败")
+
+                # HTML 正文以 bytes 交给 lxml 按字符集解码，兼容带 XML 编码声明的页面
+                charset = html_headers.get_content_charset("utf-8")
+                doc = lxml.html.document_fromstring(html_data, parser=get_html_parser(charset))
+
+                self.empty_msg(doc)
+
+                css_content = self.process_styles(doc)
+
+                tasks = []
+                resource_map = {}
+                os.makedirs(resource_dir, exist_ok=True)
+
+                # 资源总数在遍历过程中动态累加，无需预先单独计数
+                with tqdm(total=0, desc="资源转存进度", ncols=100) as progress_bar:
+                    for headers, body in parts:
+                        if not (content_location := headers.get("Content-Location", "").strip()):
+                            continue
+
+                        content_type = headers.get_content_type()
+                        if content_type.startswith("text/html"):
+                            continue
+
+                        encoding = headers.get("Content-Transfer-Encoding", "7bit").strip().lower()
+
+                        progress_bar.total += 1
+                        tasks.append((content_location, content_type, body, encoding))
+
+                    # 结果按资源地址写入 resource_map，无需关心完成顺序
+                    for result in self.executor.map(
+                        lambda task: save_resource(*task, resource_dir, progress_bar.update),  # 更新进度条
+                        tasks
+                    ):
+                        if result:
+                            resource_map[sys.intern(result[0])] = result[1]
+            finally:
+                # 先释放所有指向映射的切片再关闭映射；异常回溯仍持有切片时留待回收
+                parts = html_part = html_body = body = tasks = None
+                with contextlib.suppress(BufferError):
+                    buffer.close()
+
+            self.update_references(doc, resource_map, output_path)
 
             if css_content:
-                style_tag = soup.new_tag("style", type="text/css")
-                style_tag.string = css_content
-                if soup.head:
-                    soup.head.append(style_tag)
-                else:
-                    soup.html.insert(0, soup.new_tag("head")).append(style_tag)
-
-            with open(output_path, "w", encoding="utf-8") as f:
-                f.write(str(soup))
+                if (head := doc.head) is None:
+                    head = lxml.html.Element("head")
+                    doc.insert(0, head)
+                style_tag = etree.SubElement(head, "style", type="text/css")
+                style_tag.text = css_content
+
+            self.update_charset(doc)
+
+            # 增量序列化直接写入文件，不在内存中拼出完整的输出
+            with open(output_path, "wb") as f, etree.htmlfile(f, encoding="utf-8") as xf:
+                # libxml2 会为缺少 DOCTYPE 的文档补上默认值，仅当原文确有声明时才写出
+                if b"<!doctype" in html_data[:1024].lower():
+                    xf.write_doctype(doc.getroottree().docinfo.doctype)
+                xf.write(doc)
 
             print(f"转换成功: {output_path}")
             return True